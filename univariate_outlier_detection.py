@@ -3,14 +3,40 @@ Robust univariate outlier detection
 @author: Rory Boyle rorytboyle@gmail.com
 @date: 05/12/2019
 """
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 import pandas as pd
 import numpy as np
-import statsmodels.robust as robust
+
+# optional backends
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Consistency constant for the MAD of normally distributed data, i.e. the
+# 0.75 quantile of the standard normal (same default as
+# statsmodels.robust.scale.mad)
+MAD_NORMAL_CONSTANT = 0.6744897501960817
 
 def make_boolean_column(col):
     """
     Creates a boolean column where True=value that is identifed as an outlier
-    using MAD criterion
+    using MAD criterion. detect_univariate_outliers no longer calls this
+    (it compares all columns at once); kept for existing callers.
     
     :param col: df containing single col from df containing data with upper and
     lower rejection thresholds appended.
@@ -23,41 +49,297 @@ def make_boolean_column(col):
     
     return outlier_bool
 
-def replace_outliers(col):
+def replace_outliers(col, upper=None, lower=None):
     """ 
     Replaces identified outliers with the median +/- (t * Median Absolute
-    Deviation) where t = threshold as specified in detect_univariate_outliers
+    Deviation) where t = threshold as specified in detect_univariate_outliers.
+    detect_univariate_outliers no longer calls this (it clips all columns at
+    once); kept for existing callers.
     
     :param col: df containing single col from df containing data with upper and
-    lower rejection thresholds appended.
+    lower rejection thresholds appended (or just the data, if upper and lower
+    are given).
+    :param upper: upper rejection threshold. If None, taken from col['upper'].
+    :param lower: lower rejection threshold. If None, taken from col['lower'].
+    Passing both (e.g. with functools.partial) avoids looking them up in col.
     :return col: df with single col containing data where outliers 
     have been replaced with next most extreme values   
     """
-    # get column where nan == True
-    nan_col = col.isnull()
-    
     # replace outliers above upper threshold with the upper threshold value
-    # (i.e. the median + (t * MAD))
-    upperThresh = col.loc['upper'].item()
-    col.where(col <= upperThresh, upperThresh, inplace=True)
+    # (i.e. the median + (t * MAD)) and outliers below lower threshold with
+    # the lower threshold value (i.e. the median - (t * MAD)). clip leaves
+    # nans as nans.
+    if upper is None:
+        upper = col.loc['upper'].item()
+    if lower is None:
+        lower = col.loc['lower'].item()
+    
+    return col.clip(lower=lower, upper=upper)
+    
+def _column_medians(arr, median, n_jobs=None, overwrite_input=False):
+    """
+    Calculates the median of each column of a 2D array, optionally splitting
+    the columns into blocks that are processed on a thread pool (NumPy
+    releases the GIL while partitioning).
+    
+    :param arr: 2D float array (rows = cases, columns = variables p)
+    :param median: np.median or np.nanmedian
+    :param n_jobs: number of threads. None or 1 = no thread pool, -1 = one
+    thread per CPU.
+    :param overwrite_input: Boolean stating whether arr may be partitioned in
+    place
+    :return: 1D array containing the median of each column
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs or 1, arr.shape[1])
+    if n_jobs <= 1:
+        return median(arr, axis=0, overwrite_input=overwrite_input)
+    
+    # blocks are views of arr, so overwrite_input still avoids copies
+    blocks = np.array_split(arr, n_jobs, axis=1)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        medians = executor.map(
+            lambda block: median(block, axis=0,
+                                 overwrite_input=overwrite_input), blocks)
+        return np.concatenate(list(medians))
+
+def _detect_numpy(arr, threshold, replace, use_numexpr=False, n_jobs=None):
+    """
+    Detects (and optionally replaces) outliers in each column of a 2D float
+    array using NumPy (and, optionally, numexpr for the comparison and
+    replacement). See detect_univariate_outliers.
+    
+    :param arr: 2D float array (rows = cases, columns = variables p). Clipped
+    in place if replace=True.
+    :param threshold: rejection threshold
+    :param replace: Boolean stating whether detected outliers should be
+    replaced
+    :param use_numexpr: Boolean stating whether numexpr should be used to
+    check for and replace outliers
+    :param n_jobs: number of threads used to calculate medians (see
+    _column_medians)
+    :return bool_arr: Boolean array containing True where a value is an outlier
+    :return arr: arr with outliers replaced (None if replace=False)
+    """
+    if use_numexpr and ne is None:
+        raise ImportError("backend='numexpr' requires numexpr to be installed")
+    
+    # Calculate median and MAD for each variable p
+    # nanmedian ignores nans within each column, so columns do not have to be
+    # handled individually. It can be much slower than median though, so
+    # only use it if there are nans.
+    median = np.nanmedian if np.isnan(arr).any() else np.median
+    med = _column_medians(arr, median, n_jobs)
+    # (absolute deviations are taken in place in a single temporary, which
+    # median may then partition in place)
+    dev = arr - med[None, :]
+    np.abs(dev, out=dev)
+    mad = (_column_medians(dev, median, n_jobs, overwrite_input=True) /
+           MAD_NORMAL_CONSTANT)
+    
+    # Calculate upper and lower rejection thresholds
+    # (kept as arrays alongside the data rather than appended to a df)
+    spread = threshold * mad
+    upper = med + spread
+    lower = med - spread
+    
+    # columns where MAD = 0 (e.g. constant columns) are not checked for
+    # outliers: with no spread every value != median would be an outlier.
+    # Infinite thresholds mean nothing is flagged or replaced in them.
+    no_spread = mad == 0
+    if no_spread.any():
+        upper[no_spread] = np.inf
+        lower[no_spread] = -np.inf
+    
+    # check for outliers
+        ## thresholds are broadcast across rows so every column is compared
+        ## against its own upper and lower threshold in a single pass
+        ## (numexpr does both comparisons in one multithreaded pass with no
+        ## temporaries)
+    upper = upper[None, :]
+    lower = lower[None, :]
+    if use_numexpr:
+        bool_arr = ne.evaluate('(arr > upper) | (arr < lower)')
+    else:
+        bool_arr = arr > upper
+        bool_arr |= arr < lower
+    
+    # replace outliers with median +/- (threshold * MAD) 
+    if replace:
+        # nans compare False against both thresholds so are left as nans
+        if use_numexpr:
+            ne.evaluate('where(arr > upper, upper, '
+                        'where(arr < lower, lower, arr))', out=arr)
+        else:
+            np.clip(arr, lower, upper, out=arr)
+        return bool_arr, arr
+    else:
+        return bool_arr, None
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _numba_median(buf):
+        """
+        Returns the median of a 1D array with no nans, partially sorting it
+        (O(n)) with np.partition rather than fully sorting it.
+        """
+        n = buf.size
+        k = n // 2
+        part = np.partition(buf, k)
+        if n % 2 == 1:
+            return part[k]
+        else:
+            # even n: average the two middle values (part[:k] are all <=
+            # part[k], so the lower middle value is their max)
+            return (part[:k].max() + part[k]) / 2
+
+    @numba.njit(parallel=True, cache=True)
+    def _numba_kernel(arr, threshold, bool_arr, out, replace):
+        """
+        Detects outliers in each column of arr (columns processed in
+        parallel), writing True into bool_arr where a value is an outlier and,
+        if replace=True, writing clipped values into out (which may be arr).
+        """
+        nrows, ncols = arr.shape
+        for j in numba.prange(ncols):
+            # copy non-nan values of column into a scratch buffer
+            buf = np.empty(nrows, dtype=arr.dtype)
+            n = 0
+            for i in range(nrows):
+                if not np.isnan(arr[i, j]):
+                    buf[n] = arr[i, j]
+                    n += 1
+            if n == 0:
+                # column is entirely nan, so it has no outliers
+                continue
+            
+            # Calculate median and MAD (absolute deviations are written back
+            # into the scratch buffer, so the column is only read once)
+            med = _numba_median(buf[:n])
+            for i in range(n):
+                buf[i] = abs(buf[i] - med)
+            mad = _numba_median(buf[:n]) / MAD_NORMAL_CONSTANT
+            if mad == 0:
+                # no spread (e.g. constant column), so not checked
+                continue
+            upper = med + (threshold * mad)
+            lower = med - (threshold * mad)
+            
+            # check for outliers and replace them (nans are neither)
+            for i in range(nrows):
+                v = arr[i, j]
+                if v > upper:
+                    bool_arr[i, j] = True
+                    if replace:
+                        out[i, j] = upper
+                elif v < lower:
+                    bool_arr[i, j] = True
+                    if replace:
+                        out[i, j] = lower
+
+def _detect_numba(arr, threshold, replace):
+    """
+    Detects (and optionally replaces) outliers in each column of a 2D float
+    array using a compiled Numba kernel that processes columns in parallel.
+    See detect_univariate_outliers.
     
-    # replace outliers below lower threshold with the lower threshold value
-    # (i.e. the median - (t * MAD))
-    lowerThresh = col.loc['lower'].item()    
-    col.where(col >= lowerThresh, lowerThresh, inplace=True)
+    :param arr: 2D float array (rows = cases, columns = variables p). Clipped
+    in place if replace=True.
+    :param threshold: rejection threshold
+    :param replace: Boolean stating whether detected outliers should be
+    replaced
+    :return bool_arr: Boolean array containing True where a value is an outlier
+    :return arr: arr with outliers replaced (None if replace=False)
+    """
+    if numba is None:
+        raise ImportError("backend='numba' requires numba to be installed")
     
-    # change where values should be nans back to nans
-    col.where(nan_col==False, np.nan, inplace=True)
+    bool_arr = np.zeros(arr.shape, dtype=np.bool_)
+    # arr may be read-only if replace=False, so write replaced values through
+    # a separate (empty when unused) output argument
+    out = arr if replace else np.empty((0, 0), dtype=arr.dtype)
+    _numba_kernel(arr, threshold, bool_arr, out, replace)
     
-    return col
+    if replace:
+        return bool_arr, arr
+    else:
+        return bool_arr, None
+
+def _detect_polars(df, threshold, replace, dtype):
+    """
+    Detects (and optionally replaces) outliers in each column of df using a
+    Polars lazy query, so that columns are processed in parallel. See
+    detect_univariate_outliers.
     
-def detect_univariate_outliers(df, threshold=2.5, replace=True):
+    :param df: pandas df containing data to be checked for outliers
+    :param threshold: rejection threshold
+    :param replace: Boolean stating whether detected outliers should be
+    replaced
+    :param dtype: NumPy float dtype to run the detection in
+    :return bool_arr: Boolean array containing True where a value is an outlier
+    :return replaced: float array with outliers replaced (None if
+    replace=False)
+    """
+    if pl is None:
+        raise ImportError("backend='polars' requires polars to be installed")
+    
+    # polars needs string column names, so use column positions. nans are
+    # converted to nulls so that they are ignored by median()
+    names = [str(j) for j in range(df.shape[1])]
+    pl_dtype = pl.Float32 if dtype == np.float32 else pl.Float64
+    lf = pl.from_pandas(df.set_axis(names, axis=1)).lazy().select(
+        pl.all().cast(pl_dtype))
+
+    # Calculate median and MAD for each variable p (medians skip nulls)
+    med = pl.all().median()
+    mad = (pl.all() - med).abs().median() / MAD_NORMAL_CONSTANT
+    stats = lf.select(med, mad.name.suffix('_mad')).collect().row(0)
+    meds, mads = stats[:len(names)], stats[len(names):]
+
+    # check for outliers (and replace them) against each column's own upper
+    # and lower rejection thresholds
+    bool_exprs = []
+    replace_exprs = []
+    for name, col_med, col_mad in zip(names, meds, mads):
+        col = pl.col(name)
+        if col_med is None or col_mad == 0:
+            # column is entirely nan, or has no spread (e.g. constant
+            # column), so is not checked for outliers
+            bool_exprs.append(pl.repeat(False, pl.len())
+                              .alias('outlier_' + name))
+            replace_exprs.append(col.alias('replaced_' + name))
+            continue
+        upper = col_med + (threshold * col_mad)
+        lower = col_med - (threshold * col_mad)
+        
+        bool_exprs.append(((col > upper) | (col < lower)).fill_null(False)
+                          .alias('outlier_' + name))
+        replace_exprs.append(col.clip(lower_bound=lower, upper_bound=upper)
+                             .alias('replaced_' + name))
+    
+    if not replace:
+        replace_exprs = []
+    result = lf.select(bool_exprs + replace_exprs).collect()
+    
+    bool_arr = result.select(pl.col('^outlier_.*$')).to_numpy()
+    if replace:
+        # nulls come back as nans
+        return bool_arr, result.select(pl.col('^replaced_.*$')).to_numpy()
+    else:
+        return bool_arr, None
+    
+def detect_univariate_outliers(df, threshold=2.5, replace=True,
+                               backend='numpy', dtype=None, arrow_mask=False,
+                               n_jobs=None):
     """
     Detects outliers in a dataframe and returns a boolean dataframe where True
     = outlier, and False = not an outlier. Detects outliers based on criterion
     of median +/- (t * Median Absolute Deviation) where t = a specified 
     threshold. Also returns a 'winsorized' dataframe where outliers are
     replaced with a value = median +/- (t * Median Absolute Deviation) 
+    Columns with a Median Absolute Deviation of 0 (e.g. constant columns) are
+    not checked, i.e. contain no outliers and are returned unchanged.
 
     :param df: pandas df containing data to be checked for outliers
     :param threshold: rejection threshold. Default = 2.5 (Leys et al., 2013). 
@@ -67,44 +349,68 @@ def detect_univariate_outliers(df, threshold=2.5, replace=True):
     :param replace: Boolean stating whether detected outliers should be 
     replaced. If True, detected outliers will be replaced with next most
     extreme values that do not exceed rejection threshold.
+    :param backend: 'numpy' (default), 'polars', 'numba' or 'numexpr'.
+    'polars' (requires polars) and 'numba' (requires numba) process columns
+    in parallel, which is faster for large dfs on multiple cores. 'numexpr'
+    (requires numexpr) is the same as 'numpy' but checks for and replaces
+    outliers using multiple threads.
+    :param dtype: float dtype to run the detection in. Default = None
+    (float64). np.float32 halves memory use and is faster for large dfs, at
+    the cost of precision. replaced is returned as float64 either way.
+    :param arrow_mask: Boolean stating whether outlier_df should use
+    Arrow-backed bool columns (requires pyarrow), which store 1 bit per value
+    rather than 1 byte.
+    :param n_jobs: number of threads used to calculate medians with the
+    'numpy' and 'numexpr' backends. Default = None (1 thread); -1 = one
+    thread per CPU. Faster for dfs with many columns on multiple cores.
     :return outlier_df: Boolean df containing True in cases containing 
     identified outliers and False elsewhere.
     :return replaced: df containing data with outliers replaced (only returned
     if replace=True)
     """
-    # Calculate MAD for each variable p
-    # Have to use list comprehension as nans must be dropped individually from
-    # each column as robust.scale.mad() cannot handle nans.
-    mad_values = [robust.scale.mad(df[[col]].dropna()).item() for col in df.columns]
-
-    # turn list into dataframe
-    mad=pd.DataFrame([mad_values], columns=df.columns, index=['mad'])
-
-    # Get median and add to mad dataframe
-    median = df.median().rename('median')
-    mad = mad.append(median)
-    
-    # Calculate upper and lower rejection thresholds
-    upper=[mad.loc['median', col] + (threshold * mad.loc['mad', col]) for
-           col in mad.columns]
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("dtype must be float32 or float64, got %r"
+                         % (dtype,))
     
-    lower=[mad.loc['median', col] - (threshold * mad.loc['mad', col]) for
-           col in mad.columns]
-    
-    # append thresholds to df
-    rej_thresholds = pd.DataFrame([upper, lower], columns=mad.columns, 
-                                  index=['upper', 'lower'])
-    mad = mad.append(rej_thresholds)
-    
-    # check for outliers - create boolean Df
-        ## merge mad with df so that df can call apply function - save df as 
-        ## temporary df
-    temp_df = df.append(mad.loc[['upper', 'lower'],:])
-    outlier_df = temp_df.apply(make_boolean_column).drop(['upper', 'lower'])
+    if backend in ('numpy', 'numba', 'numexpr'):
+        # get data as a single float array (columns = variables p)
+            ## a private copy is only taken when outliers will be replaced, so
+            ## that it can be clipped in place without touching df
+        arr = df.to_numpy(dtype=dtype, copy=replace)
+        if backend == 'numpy':
+            bool_arr, replaced = _detect_numpy(arr, threshold, replace,
+                                               n_jobs=n_jobs)
+        elif backend == 'numexpr':
+            bool_arr, replaced = _detect_numpy(arr, threshold, replace,
+                                               use_numexpr=True, n_jobs=n_jobs)
+        else:
+            bool_arr, replaced = _detect_numba(arr, threshold, replace)
+    elif backend == 'polars':
+        bool_arr, replaced = _detect_polars(df, threshold, replace, dtype)
+    else:
+        raise ValueError("backend must be 'numpy', 'polars', 'numba' or "
+                         "'numexpr', got %r" % (backend,))
+
+    # make sure outlier_df is a plain (1 byte per value) bool df whatever the
+    # backend returned, or bit-packed Arrow bool columns if requested
+    bool_arr = bool_arr.astype(np.bool_, copy=False)
+    if arrow_mask:
+        if pa is None:
+            raise ImportError("arrow_mask=True requires pyarrow to be "
+                              "installed")
+        outlier_df = pd.DataFrame(
+            {j: pd.arrays.ArrowExtensionArray(pa.array(bool_arr[:, j]))
+             for j in range(bool_arr.shape[1])}, index=df.index)
+        outlier_df.columns = df.columns
+    else:
+        outlier_df = pd.DataFrame(bool_arr, index=df.index,
+                                  columns=df.columns)
     
-    # replace outliers with median +/- (threshold * MAD) 
     if replace:
-        replaced_df = temp_df.apply(replace_outliers).drop(['upper', 'lower'])
+        # return float64 regardless of the working dtype, as before
+        replaced_df = pd.DataFrame(replaced.astype(np.float64, copy=False),
+                                   index=df.index, columns=df.columns)
         return outlier_df, replaced_df
     else:
         return outlier_df